@@ -1,7 +1,17 @@
 import asyncio
+import csv
+import functools
+import io
 import logging
 import os
+import queue
 import re
+import string
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing, contextmanager
+from typing import NamedTuple
 import pyodbc
 from mcp.server import Server
 from mcp.types import Resource, Tool, TextContent
@@ -14,10 +24,22 @@ logging.basicConfig(
 )
 logger = logging.getLogger("mssql_mcp_server")
 
+# Patterns used on every request, compiled once
+_PWD_RE = re.compile(r'PWD=[^;]+')
+_TABLES_VIEW_RE = re.compile(r'INFORMATION_SCHEMA\.TABLES', re.IGNORECASE)
+
+# Characters allowed in a table name: alphanumeric, underscore and dot
+_TABLE_NAME_CHARS = frozenset(string.ascii_letters + string.digits + "_.")
+
 def validate_table_name(table_name: str) -> str:
     """Validate and escape table name to prevent SQL injection."""
-    # Allow only alphanumeric, underscore, and dot (for schema.table)
-    if not re.match(r'^[a-zA-Z0-9_]+(\.[a-zA-Z0-9_]+)?$', table_name):
+    # Allow only alphanumeric, underscore, and at most one dot
+    # (for schema.table) with a name on each side of it
+    if (not table_name
+            or not _TABLE_NAME_CHARS.issuperset(table_name)
+            or table_name.count('.') > 1
+            or table_name.startswith('.')
+            or table_name.endswith('.')):
         raise ValueError(f"Invalid table name: {table_name}")
     
     # Split schema and table if present
@@ -29,8 +51,35 @@ def validate_table_name(table_name: str) -> str:
         # Just table name
         return f"[{table_name}]"
 
+# SQL Server ODBC drivers in order of preference
+_PREFERRED_DRIVERS = (
+    "ODBC Driver 18 for SQL Server",
+    "ODBC Driver 17 for SQL Server",
+    "SQL Server Native Client 11.0",
+    "SQL Server",
+)
+
+def detect_driver() -> str:
+    """Return the most recent SQL Server ODBC driver installed on this machine."""
+    try:
+        installed = set(pyodbc.drivers())
+    except pyodbc.Error:
+        installed = set()
+    return next(
+        (d for d in _PREFERRED_DRIVERS if d in installed),
+        "ODBC Driver 17 for SQL Server",
+    )
+
+# Scanned once; listing drivers touches the ODBC driver manager config
+_DEFAULT_DRIVER = detect_driver()
+
+@functools.lru_cache(maxsize=1)
 def get_connection_string():
-    """Get database connection string from environment variables."""
+    """
+    Get database connection string from environment variables.
+    The result is cached for the lifetime of the process; call
+    get_connection_string.cache_clear() after changing the environment.
+    """
     server = os.getenv("MSSQL_SERVER", "localhost")
     database = os.getenv("MSSQL_DATABASE")
     user = os.getenv("MSSQL_USER")
@@ -42,20 +91,13 @@ def get_connection_string():
         # For ODBC, LocalDB format is typically (localdb)\InstanceName
         pass # pyodbc handles this usually
     
-    logger.info(f"Using server: {server}")
+    logger.info("Using server: %s", server)
 
     # Build connection string
-    # Try using 'ODBC Driver 17 for SQL Server' as default
-    driver = "{ODBC Driver 17 for SQL Server}"
-    
-    # Check if we should fallback to standard 'SQL Server' driver (often pre-installed on Windows)
-    # Ideally we'd scan available drivers, but for now let's try a robust default approach
-    # We can also check pyodbc.drivers() if needed, but let's stick to simple env config first.
-    
-    # Check if user specified a driver
+    # Check if user specified a driver, otherwise use the newest SQL Server
+    # driver found at import time
     env_driver = os.getenv("MSSQL_DRIVER")
-    if env_driver:
-        driver = f"{{{env_driver}}}"
+    driver = f"{{{env_driver or _DEFAULT_DRIVER}}}"
     
     conn_str = f"DRIVER={driver};SERVER={server},{port};DATABASE={database}"
     
@@ -71,9 +113,52 @@ def get_connection_string():
         conn_str += ";Encrypt=yes"
         if os.getenv("MSSQL_TRUST_SERVER_CERTIFICATE", "false").lower() == "true":
              conn_str += ";TrustServerCertificate=yes"
+    elif not env_driver:
+        # A detected Driver 18+ encrypts by default; keep the documented
+        # default off. An explicitly chosen driver keeps its own default.
+        conn_str += ";Encrypt=no"
              
     return conn_str
 
+def get_int_env(name: str, default: int) -> int:
+    """
+    Read a non-negative integer setting from the environment, falling back
+    to default if it is missing or invalid.
+    """
+    value = os.getenv(name)
+    if value is None:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        number = None
+    if number is None or number < 0:
+        logger.warning("Invalid value for %s: %r, using %s", name, value, default)
+        return default
+    return number
+
+class Settings(NamedTuple):
+    """Tuning settings read from MSSQL_* environment variables."""
+    pool_size: int
+    pool_min_size: int
+    schema_ttl: int
+    max_rows: int
+    resource_rows: int
+
+@functools.lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """
+    Get the tuning settings, read from the environment once per process.
+    Call get_settings.cache_clear() after changing the environment.
+    """
+    return Settings(
+        pool_size=get_int_env("MSSQL_POOL_SIZE", 5),
+        pool_min_size=get_int_env("MSSQL_POOL_MIN_SIZE", 1),
+        schema_ttl=get_int_env("MSSQL_SCHEMA_TTL", 60),
+        max_rows=get_int_env("MSSQL_MAX_ROWS", 1000),
+        resource_rows=get_int_env("MSSQL_RESOURCE_ROWS", 100),
+    )
+
 def get_command():
     """Get the command to execute SQL queries."""
     return os.getenv("MSSQL_COMMAND", "execute_sql")
@@ -83,55 +168,443 @@ def is_select_query(query: str) -> bool:
     Check if a query is a SELECT statement, accounting for comments.
     Handles both single-line (--) and multi-line (/* */) SQL comments.
     """
-    # Remove multi-line comments /* ... */
-    query_cleaned = re.sub(r'/\*.*?\*/', '', query, flags=re.DOTALL)
-    
-    # Remove single-line comments -- ...
-    lines = query_cleaned.split('\n')
-    cleaned_lines = []
-    for line in lines:
-        # Find -- comment marker and remove everything after it
-        comment_pos = line.find('--')
-        if comment_pos != -1:
-            line = line[:comment_pos]
-        cleaned_lines.append(line)
-    
-    query_cleaned = '\n'.join(cleaned_lines)
-    
-    # Get the first non-empty word after stripping whitespace
-    first_word = query_cleaned.strip().split()[0] if query_cleaned.strip() else ""
-    return first_word.upper() == "SELECT"
-
-# Global connection handler
-class DBConnection:
-    _conn = None
-    
-    @classmethod
-    def get_connection(cls):
-        conn_str = get_connection_string()
-        # If no connection or closed, connect
-        if cls._conn is None:
-            logger.info("Initializing new persistent connection...")
-            cls._conn = pyodbc.connect(conn_str)
+    # Only the first keyword matters: walk past leading whitespace and
+    # comments by index instead of building a cleaned copy of the query
+    i, n = 0, len(query)
+    while i < n:
+        c = query[i]
+        if c.isspace():
+            i += 1
+        elif query.startswith('--', i):
+            end = query.find('\n', i + 2)
+            i = n if end == -1 else end + 1
+        elif query.startswith('/*', i):
+            end = query.find('*/', i + 2)
+            i = n if end == -1 else end + 2
         else:
-            # Check if connection is still alive using a lightweight valid check
+            break
+    
+    if query[i:i + 6].upper() != "SELECT":
+        return False
+    # Reject identifiers that merely start with SELECT, e.g. SELECTED
+    return i + 6 == n or not (query[i + 6].isalnum() or query[i + 6] == '_')
+
+# Rows pulled from the driver per round of fetchmany
+_FETCH_BATCH_SIZE = 1000
+
+def truncation_note(max_rows: int) -> str:
+    """Line appended to results cut off at max_rows."""
+    return f"(truncated at {max_rows} rows; raise MSSQL_MAX_ROWS to see more)"
+
+def format_rows(cursor, max_rows: int = 0) -> str:
+    """
+    Render the pending result set of cursor as CSV text, fetching in batches.
+    With max_rows > 0, stop after that many rows and say so in the output.
+    """
+    buf = io.StringIO()
+    # csv quotes values containing commas, quotes or newlines
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow([desc[0] for desc in cursor.description])
+    remaining = max_rows
+    while True:
+        size = _FETCH_BATCH_SIZE
+        if max_rows > 0:
+            # One row past the cap tells us whether anything was cut off
+            size = min(size, remaining + 1)
+        batch = cursor.fetchmany(size)
+        if not batch:
+            break
+        if max_rows > 0:
+            if len(batch) > remaining:
+                writer.writerows(batch[:remaining])
+                return buf.getvalue() + truncation_note(max_rows)
+            remaining -= len(batch)
+        writer.writerows(batch)
+    return buf.getvalue().removesuffix("\n")
+
+# Statements that may change data even though they start with SELECT
+_WRITE_KEYWORD_RE = re.compile(
+    r'\b(INTO|INSERT|UPDATE|DELETE|MERGE|EXEC|EXECUTE|CREATE|ALTER|DROP|TRUNCATE)\b',
+    re.IGNORECASE,
+)
+
+def is_read_only_query(query: str) -> bool:
+    """
+    Conservatively check that running query twice cannot change data.
+    Only a single SELECT without INTO or other write keywords qualifies.
+    """
+    return (is_select_query(query)
+            and ';' not in query.rstrip().rstrip(';')
+            and not _WRITE_KEYWORD_RE.search(query))
+
+def is_disconnect(error: BaseException) -> bool:
+    """Check whether a pyodbc error means the link to the server is gone."""
+    if isinstance(error, pyodbc.InterfaceError):
+        return True
+    if isinstance(error, pyodbc.OperationalError):
+        # SQLSTATE class 08 is a connection failure; pyodbc also raises
+        # OperationalError for query timeouts (HYT00), which leave the
+        # connection usable
+        return bool(error.args) and str(error.args[0]).startswith("08")
+    return False
+
+# Prepared cursors kept per pooled connection
+_STATEMENT_CACHE_SIZE = 32
+
+# Session state a query can change with USE or SET and that would leak
+# into the next request borrowing the connection
+_SESSION_STATE = "DB_NAME(), @@OPTIONS, @@LANGID"
+
+# Rolls back any transaction a request left open, resets SET ROWCOUNT
+# (which no function reports) and returns the open transaction count
+# followed by the session state
+_RELEASE_SQL = f"""
+    DECLARE @open_transactions int = @@TRANCOUNT;
+    IF @open_transactions > 0 ROLLBACK TRANSACTION;
+    SET ROWCOUNT 0;
+    SELECT @open_transactions, {_SESSION_STATE};
+"""
+
+class ConnectionPool:
+    """
+    Bounded pool of pyodbc connections.
+    Each request borrows its own connection, so concurrent requests do not
+    queue up behind a single shared connection.
+    """
+    
+    def __init__(self, size: int, min_size: int = 0):
+        self.size = max(size, 1)
+        self.min_size = max(min(min_size, self.size), 0)
+        self._idle: queue.Queue[pyodbc.Connection] = queue.Queue(maxsize=self.size)
+        self._lock = threading.Lock()
+        self._created = 0
+        # Per-connection LRU of {sql: (sql, cursor)}, keyed by id(conn)
+        self._statements: dict[int, OrderedDict] = {}
+        # Session state of each connection when it was opened, keyed by id(conn)
+        self._sessions: dict[int, tuple] = {}
+    
+    def _connect(self):
+        logger.info("Opening new pooled connection...")
+        # Autocommit: each ad-hoc statement is its own transaction, so no
+        # extra commit round-trip. Explicit transactions are closed in _reset.
+        conn = pyodbc.connect(get_connection_string(), autocommit=True)
+        try:
+            with closing(conn.execute(f"SELECT {_SESSION_STATE}")) as cursor:
+                self._sessions[id(conn)] = tuple(cursor.fetchone())
+        except Exception:
+            conn.close()
+            raise
+        return conn
+    
+    def _reserve(self) -> bool:
+        """Claim a slot for a new connection if the pool is not full."""
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return True
+            return False
+    
+    def _open(self):
+        try:
+            return self._connect()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+    
+    def _discard(self, conn):
+        self._statements.pop(id(conn), None)
+        self._sessions.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._created -= 1
+    
+    def _reset(self, conn) -> bool:
+        """Clean up after arbitrary SQL; False if conn should be discarded."""
+        # A query may have opened a transaction (BEGIN TRAN without COMMIT).
+        # conn.rollback() is a no-op in autocommit mode, so roll it back in
+        # SQL before the next request inherits it and its locks.
+        try:
+            with closing(conn.execute(_RELEASE_SQL)) as cursor:
+                open_transactions, *session = cursor.fetchone()
+        except Exception:
+            return False
+        if open_transactions:
+            logger.warning("Rolled back %s open transaction(s) left by a query", open_transactions)
+        # USE, SET IMPLICIT_TRANSACTIONS, SET LANGUAGE, ... cannot be undone
+        # generically, so a connection whose session changed is not reused
+        if tuple(session) != self._sessions.get(id(conn)):
+            logger.info("Closing pooled connection whose session settings changed")
+            return False
+        return True
+    
+    def _release(self, conn, reset: bool = False):
+        if reset and not self._reset(conn):
+            self._discard(conn)
+            return
+        self._idle.put(conn)
+    
+    def prepared_cursor(self, conn, sql: str):
+        """
+        Return a cursor of conn reserved for sql and the SQL string to run.
+        pyodbc keeps the statement it last prepared on each cursor, so
+        running the same text on the same cursor again skips the prepare
+        and lets the server reuse its handle and cached plan.
+        """
+        cursors = self._statements.setdefault(id(conn), OrderedDict())
+        entry = cursors.pop(sql, None)
+        if entry is None:
+            entry = (sql, conn.cursor())
+        cursors[sql] = entry
+        if len(cursors) > _STATEMENT_CACHE_SIZE:
+            _, (_, evicted) = cursors.popitem(last=False)
+            evicted.close()
+        return entry
+    
+    def forget_cursor(self, conn, sql: str):
+        """Drop and close the cursor reserved for sql, e.g. after an error."""
+        cursors = self._statements.get(id(conn))
+        if cursors is None:
+            return
+        entry = cursors.pop(sql, None)
+        if entry is not None:
             try:
-                # Need to verify if the connection is really open. 
-                # Pyodbc doesn't have a reliable .open property that checks network state.
-                # We'll try a fast no-op query.
-                cursor = cls._conn.cursor()
-                cursor.execute("SELECT 1")
-                cursor.fetchall() # Consume result
-                cursor.close()
-            except Exception as e:
-                logger.warning(f"Connection lost ({e}), reconnecting...")
-                try:
-                    cls._conn.close()
-                except:
-                    pass
-                cls._conn = pyodbc.connect(conn_str)
-        
-        return cls._conn
+                entry[1].close()
+            except Exception:
+                pass
+    
+    def warm_up(self):
+        """Open min_size connections ahead of the first request."""
+        while self._created < self.min_size and self._reserve():
+            self._idle.put(self._open())
+    
+    def clear(self):
+        """Close all idle connections, e.g. after the server went away."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+    
+    def _checkout(self):
+        while True:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            if self._reserve():
+                return self._open()
+            # Pool exhausted: wait for another request to give one back.
+            # The timeout lets us notice slots freed by discarded connections.
+            try:
+                return self._idle.get(timeout=1)
+            except queue.Empty:
+                continue
+    
+    @contextmanager
+    def acquire(self, reset: bool = False):
+        """
+        Borrow a connection for the duration of the with block.
+        Pass reset=True when the block runs arbitrary SQL, to undo what it
+        may have left open before the connection is reused. That costs a
+        round-trip, so the server's own fixed queries skip it.
+        """
+        conn = self._checkout()
+        try:
+            yield conn
+        except BaseException as e:
+            if is_disconnect(e):
+                self._discard(conn)
+            else:
+                self._release(conn, reset)
+            raise
+        else:
+            self._release(conn, reset)
+
+@functools.lru_cache(maxsize=1)
+def get_pool() -> ConnectionPool:
+    """Get the process-wide connection pool."""
+    return ConnectionPool(
+        size=get_settings().pool_size,
+        min_size=get_settings().pool_min_size,
+    )
+
+def with_reconnect(func=None, *, retry_if=None, reset=False):
+    """
+    Run func(conn, ...) on a pooled connection, retrying once on a fresh
+    connection if the one we got turns out to be dead.
+    The statement may already have run when the link dropped, so callers
+    running arbitrary SQL pass retry_if(*args, **kwargs) to only retry
+    statements that are safe to run twice, and reset=True to clean up the
+    connection before it goes back to the pool.
+    """
+    if func is None:
+        return functools.partial(with_reconnect, retry_if=retry_if, reset=reset)
+    
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        pool = get_pool()
+        try:
+            with pool.acquire(reset) as conn:
+                return func(conn, *args, **kwargs)
+        except pyodbc.Error as e:
+            if not is_disconnect(e):
+                raise
+            # Idle connections most likely went down with this one
+            pool.clear()
+            if retry_if is not None and not retry_if(*args, **kwargs):
+                raise
+            logger.warning("Connection lost (%s), reconnecting...", e)
+            with pool.acquire(reset) as conn:
+                return func(conn, *args, **kwargs)
+    return wrapper
+
+# Cached result of list_resources as (timestamp, resources)
+_tables_cache: tuple[float, list[Resource]] | None = None
+
+# Statements that may add, drop or rename tables and so invalidate
+# _tables_cache. Searched anywhere in the query so DDL after a comment or
+# a SET statement is caught; a false positive only costs one refetch.
+_TABLE_DDL_RE = re.compile(
+    r'\b(CREATE|DROP|ALTER)\s+TABLE\b|\bsp_rename\b', re.IGNORECASE
+)
+
+def invalidate_tables_cache():
+    """Forget the cached table listing."""
+    global _tables_cache
+    _tables_cache = None
+
+# User tables and their row counts, fetched as two result sets in one
+# round-trip. sys.partitions keeps row counts as metadata, so no table is
+# scanned, and unlike sys.dm_db_partition_stats it needs no extra permission.
+_TABLES_METADATA_SQL = """
+    SELECT TABLE_SCHEMA, TABLE_NAME 
+    FROM INFORMATION_SCHEMA.TABLES 
+    WHERE TABLE_TYPE = 'BASE TABLE';
+    
+    SELECT OBJECT_SCHEMA_NAME(object_id), OBJECT_NAME(object_id), SUM(rows)
+    FROM sys.partitions
+    WHERE index_id IN (0, 1)
+    GROUP BY object_id;
+"""
+
+@with_reconnect
+def fetch_tables(conn):
+    """
+    Return (schema, table, row_count) for the user tables in the current
+    database. row_count is None when it is not visible to the login.
+    """
+    # Close the cursor even on errors so its statement handle is released
+    with closing(conn.cursor()) as cursor:
+        cursor.execute(_TABLES_METADATA_SQL)
+        tables = cursor.fetchall()
+        row_counts = {}
+        if cursor.nextset():
+            row_counts = {(schema, name): rows for schema, name, rows in cursor.fetchall()}
+    # Connection goes back to the pool
+    return [(schema, name, row_counts.get((schema, name))) for schema, name in tables]
+
+@with_reconnect
+def read_table(conn, safe_table: str) -> str:
+    """Return the first rows of an already validated table as CSV text."""
+    pool = get_pool()
+    # Use TOP for MSSQL (equivalent to LIMIT in MySQL). The row count is a
+    # parameter so the text, and the prepared statement, stay the same.
+    sql, cursor = pool.prepared_cursor(conn, f"SELECT TOP (?) * FROM {safe_table}")
+    try:
+        cursor.execute(sql, get_settings().resource_rows)
+        # Reads the result to the end, leaving the cursor ready for reuse
+        return format_rows(cursor)
+    except Exception:
+        pool.forget_cursor(conn, sql)
+        raise
+
+# Plain table listings that aggregate_table_names can answer server-side
+_TABLE_LIST_QUERY_RE = re.compile(
+    r"^\s*SELECT\s+TABLE_NAME\s+FROM\s+INFORMATION_SCHEMA\.TABLES"
+    r"(\s+WHERE\s+TABLE_TYPE\s*=\s*'BASE TABLE')?\s*;?\s*$",
+    re.IGNORECASE,
+)
+
+# Cleared the first time the server rejects STRING_AGG (before 2017)
+_string_agg_supported = True
+
+# SQL Server error for "'STRING_AGG' is not a recognized built-in function"
+_UNKNOWN_FUNCTION_ERROR = "(195)"
+
+def aggregate_table_names(cursor, where: str, max_rows: int) -> str | None:
+    """
+    Build the table listing as a single string with STRING_AGG, capped at
+    max_rows names like the row-by-row listing.
+    Returns None if STRING_AGG could not be used.
+    """
+    global _string_agg_supported
+    if not _string_agg_supported:
+        return None
+    top, params = ("TOP (?) ", [max_rows]) if max_rows > 0 else ("", [])
+    try:
+        # nvarchar(max) so the aggregate is not capped at 4000 characters;
+        # the total count tells whether the listing was cut off
+        cursor.execute(
+            "SELECT (SELECT STRING_AGG(CAST(TABLE_NAME AS nvarchar(max)), CHAR(10)) "
+            f"FROM (SELECT {top}TABLE_NAME FROM INFORMATION_SCHEMA.TABLES{where}) AS t), "
+            f"(SELECT COUNT(*) FROM INFORMATION_SCHEMA.TABLES{where})",
+            *params,
+        )
+    except pyodbc.ProgrammingError as e:
+        if _UNKNOWN_FUNCTION_ERROR in str(e.args[-1]):
+            logger.info("STRING_AGG unavailable, listing tables row by row: %s", e)
+            _string_agg_supported = False
+        # Anything else (permissions, ...) only skips it for this call
+        return None
+    names, total = cursor.fetchone()
+    result = ["Tables_found"]
+    if names is not None:
+        result.append(names)
+    if max_rows > 0 and total > max_rows:
+        result.append(truncation_note(max_rows))
+    return "\n".join(result)
+
+def run_statement(cursor, query: str, max_rows: int) -> str:
+    """Execute query on cursor and render at most max_rows of its result."""
+    cursor.execute(query)
+    
+    # Statements without a result set (INSERT, UPDATE, DDL, ...)
+    if cursor.description is None:
+        return f"Query executed successfully. Rows affected: {cursor.rowcount}"
+    
+    # Special handling for table listing
+    if _TABLES_VIEW_RE.search(query):
+        tables = cursor.fetchmany(max_rows + 1) if max_rows > 0 else cursor.fetchall()
+        # Need to get database name differently or parse it from conn string, 
+        # but simpler to just use generic header or omit
+        result = ["Tables_found"] 
+        result.extend([table[0] for table in (tables if max_rows <= 0 else tables[:max_rows])])
+        if max_rows > 0 and len(tables) > max_rows:
+            result.append(truncation_note(max_rows))
+        return "\n".join(result)
+    
+    return format_rows(cursor, max_rows)
+
+@with_reconnect(retry_if=is_read_only_query, reset=True)
+def execute_query(conn, query: str) -> str:
+    """Execute an arbitrary query and return its textual result."""
+    # Rows are capped on the client: SET ROWCOUNT would also cap every
+    # INSERT/UPDATE/DELETE and SELECT INTO in the same batch
+    max_rows = get_settings().max_rows
+    with closing(conn.cursor()) as cursor:
+        text = None
+        listing = _TABLE_LIST_QUERY_RE.match(query)
+        if listing:
+            text = aggregate_table_names(cursor, listing.group(1) or "", max_rows)
+        if text is None:
+            text = run_statement(cursor, query, max_rows)
+    # Connection goes back to the pool
+    return text
 
 
 # Initialize server
@@ -140,64 +613,59 @@ app = Server("mssql_mcp_server")
 @app.list_resources()
 async def list_resources() -> list[Resource]:
     """List SQL Server tables as resources."""
+    global _tables_cache
+    ttl = get_settings().schema_ttl
+    if _tables_cache is not None and time.monotonic() - _tables_cache[0] < ttl:
+        return list(_tables_cache[1])
+    
     try:
-        conn = DBConnection.get_connection()
-        cursor = conn.cursor()
-        # Query to get user tables from the current database
-        cursor.execute("""
-            SELECT TABLE_NAME 
-            FROM INFORMATION_SCHEMA.TABLES 
-            WHERE TABLE_TYPE = 'BASE TABLE'
-        """)
-        tables = cursor.fetchall()
-        logger.info(f"Found tables: {tables}")
+        # pyodbc calls block, so keep them off the event loop thread
+        tables = await asyncio.to_thread(fetch_tables)
+        # Log the count only; repr of every row is O(n) even when unused
+        logger.info("Found %d tables", len(tables))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Tables: %s", [table[1] for table in tables])
         
         resources = []
-        for table in tables:
+        for _schema, name, row_count in tables:
+            description = f"Data in table: {name}"
+            if row_count is not None:
+                description += f" (~{row_count} rows)"
             resources.append(
                 Resource(
-                    uri=f"mssql://{table[0]}/data",
-                    name=f"Table: {table[0]}",
+                    uri=f"mssql://{name}/data",
+                    name=f"Table: {name}",
                     mimeType="text/plain",
-                    description=f"Data in table: {table[0]}"
+                    description=description
                 )
             )
-        cursor.close()
-        # Do not close global conn
-        return resources
+        _tables_cache = (time.monotonic(), resources)
+        return list(resources)
     except Exception as e:
-        logger.error(f"Failed to list resources: {str(e)}")
+        logger.error("Failed to list resources: %s", e)
         return []
 
 @app.read_resource()
 async def read_resource(uri: AnyUrl) -> str:
     """Read table contents."""
     uri_str = str(uri)
-    logger.info(f"Reading resource: {uri_str}")
+    logger.info("Reading resource: %s", uri_str)
     
     if not uri_str.startswith("mssql://"):
         raise ValueError(f"Invalid URI scheme: {uri_str}")
         
-    parts = uri_str[8:].split('/')
-    table = parts[0]
+    # The table is the first path segment: mssql://<table>/data
+    rest = uri_str[8:]
+    slash = rest.find('/')
+    table = rest if slash == -1 else rest[:slash]
     
     try:
         # Validate table name to prevent SQL injection
         safe_table = validate_table_name(table)
-        
-        conn = DBConnection.get_connection()
-        cursor = conn.cursor()
-        # Use TOP 100 for MSSQL (equivalent to LIMIT in MySQL)
-        cursor.execute(f"SELECT TOP 100 * FROM {safe_table}")
-        columns = [desc[0] for desc in cursor.description]
-        rows = cursor.fetchall()
-        result = [",".join(map(str, row)) for row in rows]
-        cursor.close()
-        # Do not close global conn
-        return "\n".join([",".join(columns)] + result)
+        return await asyncio.to_thread(read_table, safe_table)
                 
     except Exception as e:
-        logger.error(f"Database error reading resource {uri}: {str(e)}")
+        logger.error("Database error reading resource %s: %s", uri, e)
         raise RuntimeError(f"Database error: {str(e)}")
 
 @app.list_tools()
@@ -226,7 +694,7 @@ async def list_tools() -> list[Tool]:
 async def call_tool(name: str, arguments: dict) -> list[TextContent]:
     """Execute SQL commands."""
     command = get_command()
-    logger.info(f"Calling tool: {name} with arguments: {arguments}")
+    logger.info("Calling tool: %s with arguments: %s", name, arguments)
     
     if name != command:
         raise ValueError(f"Unknown tool: {name}")
@@ -236,41 +704,17 @@ async def call_tool(name: str, arguments: dict) -> list[TextContent]:
         raise ValueError("Query is required")
     
     try:
-        conn = DBConnection.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(query)
-        
-        # Special handling for table listing
-        if is_select_query(query) and "INFORMATION_SCHEMA.TABLES" in query.upper():
-            tables = cursor.fetchall()
-            # Need to get database name differently or parse it from conn string, 
-            # but simpler to just use generic header or omit
-            result = ["Tables_found"] 
-            result.extend([table[0] for table in tables])
-            cursor.close()
-            # Do not close global conn
-            return [TextContent(type="text", text="\n".join(result))]
-        
-        # Regular SELECT queries
-        elif is_select_query(query):
-            columns = [desc[0] for desc in cursor.description]
-            rows = cursor.fetchall()
-            result = [",".join(map(str, row)) for row in rows]
-            cursor.close()
-            # Do not close global conn
-            return [TextContent(type="text", text="\n".join([",".join(columns)] + result))]
-        
-        # Non-SELECT queries
-        else:
-            conn.commit()
-            affected_rows = cursor.rowcount
-            cursor.close()
-            # Do not close global conn
-            return [TextContent(type="text", text=f"Query executed successfully. Rows affected: {affected_rows}")]
+        result = await asyncio.to_thread(execute_query, query)
+        return [TextContent(type="text", text=result)]
                 
     except Exception as e:
-        logger.error(f"Error executing SQL '{query}': {e}")
+        logger.error("Error executing SQL '%s': %s", query, e)
         return [TextContent(type="text", text=f"Error executing query: {str(e)}")]
+    finally:
+        # In autocommit mode DDL earlier in a batch stays applied even if a
+        # later statement fails, so invalidate on errors too
+        if _TABLE_DDL_RE.search(query):
+            invalidate_tables_cache()
 
 async def main():
     """Main entry point to run the MCP server."""
@@ -279,8 +723,14 @@ async def main():
     logger.info("Starting MSSQL MCP server...")
     conn_str = get_connection_string()
     # Log connection info (sanitize password for logs)
-    safe_conn_str = re.sub(r'PWD=[^;]+', 'PWD=***', conn_str)
-    logger.info(f"Database connection string: {safe_conn_str}")
+    safe_conn_str = _PWD_RE.sub('PWD=***', conn_str)
+    logger.info("Database connection string: %s", safe_conn_str)
+    
+    try:
+        get_pool().warm_up()
+    except Exception as e:
+        # Not fatal: connections are opened on demand by each request
+        logger.warning("Could not pre-open database connections: %s", e)
     
     async with stdio_server() as (read_stream, write_stream):
         try:
@@ -290,7 +740,7 @@ async def main():
                 app.create_initialization_options()
             )
         except Exception as e:
-            logger.error(f"Server error: {str(e)}", exc_info=True)
+            logger.error("Server error: %s", e, exc_info=True)
             raise
 
 if __name__ == "__main__":
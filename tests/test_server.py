@@ -1,11 +1,445 @@
 import pytest
-from mssql_mcp_server.server import app, list_tools, list_resources, read_resource, call_tool
+from unittest.mock import Mock, patch
+from mssql_mcp_server.server import app, list_tools, list_resources, read_resource, call_tool, get_connection_string, ConnectionPool, is_select_query, format_rows, detect_driver, fetch_tables, execute_query, with_reconnect, is_read_only_query, read_table, _TABLE_DDL_RE, get_settings, invalidate_tables_cache
 from pydantic import AnyUrl
 
 def test_server_initialization():
     """Test that the server initializes correctly."""
     assert app.name == "mssql_mcp_server"
 
+def test_connection_string_is_cached(monkeypatch):
+    """Test that the connection string is built once until the cache is cleared."""
+    monkeypatch.setenv("MSSQL_USER", "testuser")
+    monkeypatch.setenv("MSSQL_PASSWORD", "testpass")
+    monkeypatch.setenv("MSSQL_DATABASE", "testdb")
+    get_connection_string.cache_clear()
+    try:
+        first = get_connection_string()
+        monkeypatch.setenv("MSSQL_DATABASE", "otherdb")
+        assert get_connection_string() is first
+        get_connection_string.cache_clear()
+        assert "DATABASE=otherdb" in get_connection_string()
+    finally:
+        get_connection_string.cache_clear()
+
+def test_encrypt_default_only_forced_for_detected_driver(monkeypatch):
+    """Test that Encrypt=no is not added when the user picked the driver."""
+    monkeypatch.setenv("MSSQL_USER", "testuser")
+    monkeypatch.setenv("MSSQL_PASSWORD", "testpass")
+    monkeypatch.setenv("MSSQL_DATABASE", "testdb")
+    monkeypatch.delenv("MSSQL_ENCRYPT", raising=False)
+    monkeypatch.delenv("MSSQL_DRIVER", raising=False)
+    get_connection_string.cache_clear()
+    try:
+        assert "Encrypt=no" in get_connection_string()
+        monkeypatch.setenv("MSSQL_DRIVER", "ODBC Driver 18 for SQL Server")
+        get_connection_string.cache_clear()
+        conn_str = get_connection_string()
+        assert "DRIVER={ODBC Driver 18 for SQL Server}" in conn_str
+        assert "Encrypt" not in conn_str
+    finally:
+        get_connection_string.cache_clear()
+
+def test_connection_pool_reuses_connections():
+    """Test that released connections are handed out again instead of reopened."""
+    pool = ConnectionPool(size=2)
+    with patch.object(pool, "_connect", side_effect=lambda: Mock()) as connect:
+        with pool.acquire() as first:
+            pass
+        with pool.acquire() as second:
+            assert second is first
+        with pool.acquire() as a, pool.acquire() as b:
+            assert a is not b
+        assert connect.call_count == 2
+
+def _mock_connection(*states):
+    """Mock connection whose session state queries return states in order."""
+    conn = Mock()
+    conn.execute.return_value.fetchone.side_effect = states
+    return conn
+
+def test_connection_pool_rolls_back_open_transactions():
+    """Test that a transaction left open by a query is rolled back on release."""
+    pool = ConnectionPool(size=1)
+    conn = _mock_connection(("testdb", 5496, 0), (1, "testdb", 5496, 0))
+    with patch("mssql_mcp_server.server.get_connection_string", return_value=""), \
+            patch("mssql_mcp_server.server.pyodbc.connect", return_value=conn):
+        with pool.acquire(reset=True):
+            pass
+        sql = conn.execute.call_args[0][0]
+        assert "@@TRANCOUNT" in sql and "ROLLBACK" in sql
+        with pool.acquire() as again:
+            assert again is conn
+        conn.close.assert_not_called()
+
+def test_connection_pool_discards_connection_with_changed_session():
+    """Test that a connection left on another database by USE is not reused."""
+    pool = ConnectionPool(size=1)
+    conn = _mock_connection(("testdb", 5496, 0), (0, "otherdb", 5496, 0))
+    fresh = _mock_connection(("testdb", 5496, 0))
+    with patch("mssql_mcp_server.server.get_connection_string", return_value=""), \
+            patch("mssql_mcp_server.server.pyodbc.connect", side_effect=[conn, fresh]):
+        with pool.acquire(reset=True):
+            pass
+        conn.close.assert_called_once()
+        with pool.acquire() as again:
+            assert again is fresh
+
+def test_connection_pool_discards_connection_when_cleanup_fails():
+    """Test that a connection whose transaction state is unknown is closed."""
+    pool = ConnectionPool(size=1)
+    conn = Mock()
+    conn.execute.side_effect = RuntimeError("cannot roll back")
+    with patch.object(pool, "_connect", side_effect=[conn, Mock()]):
+        with pool.acquire(reset=True):
+            pass
+        conn.close.assert_called_once()
+        with pool.acquire() as fresh:
+            assert fresh is not conn
+
+def test_fixed_queries_skip_connection_reset():
+    """Test that only arbitrary SQL pays for the cleanup batch on release."""
+    pool = ConnectionPool(size=1)
+    conn = Mock()
+    conn.cursor.return_value.description = [("id",)]
+    conn.cursor.return_value.fetchmany.return_value = []
+    conn.cursor.return_value.fetchall.return_value = []
+    with patch.object(pool, "_connect", return_value=conn), \
+            patch("mssql_mcp_server.server.get_pool", return_value=pool):
+        fetch_tables()
+        read_table("[users]")
+        conn.execute.assert_not_called()
+        execute_query("SELECT id FROM users")
+        conn.execute.assert_called_once()
+
+def test_prepared_cursor_is_reused_per_statement():
+    """Test that the same SQL text gets the same cursor and SQL object back."""
+    pool = ConnectionPool(size=1)
+    conn = Mock()
+    conn.cursor.side_effect = lambda: Mock()
+    first_sql, first = pool.prepared_cursor(conn, "SELECT TOP (?) * FROM [users]")
+    sql, cursor = pool.prepared_cursor(conn, "SELECT TOP (?) * FROM " + "[users]")
+    assert cursor is first and sql is first_sql
+    _, other = pool.prepared_cursor(conn, "SELECT TOP (?) * FROM [orders]")
+    assert other is not first
+    pool.forget_cursor(conn, first_sql)
+    first.close.assert_called_once()
+
+def test_connection_pool_discards_dead_connections():
+    """Test that a connection failing with a disconnect error is not reused."""
+    import pyodbc
+    pool = ConnectionPool(size=1)
+    with patch.object(pool, "_connect", side_effect=lambda: Mock()):
+        with pytest.raises(pyodbc.OperationalError):
+            with pool.acquire() as dead:
+                raise pyodbc.OperationalError("08S01", "Communication link failure")
+        dead.close.assert_called_once()
+        with pool.acquire() as conn:
+            assert conn is not dead
+
+def test_connection_pool_keeps_connection_after_timeout():
+    """Test that a query timeout does not close the pooled connection."""
+    import pyodbc
+    pool = ConnectionPool(size=1)
+    with patch.object(pool, "_connect", side_effect=lambda: Mock()):
+        with pytest.raises(pyodbc.OperationalError):
+            with pool.acquire() as first:
+                raise pyodbc.OperationalError("HYT00", "Query timeout expired")
+        first.close.assert_not_called()
+        with pool.acquire() as conn:
+            assert conn is first
+
+def _pool_with_mock_connections():
+    pool = ConnectionPool(size=2)
+    pool._connect = lambda: Mock()
+    return pool
+
+def test_with_reconnect_retries_read_only_work():
+    """Test that a read-only call is retried once on a fresh connection."""
+    import pyodbc
+    calls = []
+    
+    @with_reconnect
+    def work(conn):
+        calls.append(conn)
+        if len(calls) == 1:
+            raise pyodbc.OperationalError("08S01", "Communication link failure")
+        return "ok"
+    
+    with patch("mssql_mcp_server.server.get_pool", return_value=_pool_with_mock_connections()):
+        assert work() == "ok"
+    assert len(calls) == 2 and calls[0] is not calls[1]
+
+@pytest.mark.parametrize("error", [
+    ("08S01", "Communication link failure"),
+    ("HYT00", "Query timeout expired"),
+])
+def test_with_reconnect_does_not_rerun_writes(error):
+    """Test that statements unsafe to repeat and timeouts are not retried."""
+    import pyodbc
+    calls = []
+    
+    @with_reconnect(retry_if=is_read_only_query)
+    def work(conn, query):
+        calls.append(query)
+        raise pyodbc.OperationalError(*error)
+    
+    with patch("mssql_mcp_server.server.get_pool", return_value=_pool_with_mock_connections()):
+        with pytest.raises(pyodbc.OperationalError):
+            work("UPDATE users SET name = 'x'")
+    assert len(calls) == 1
+
+@pytest.mark.parametrize("query, expected", [
+    ("SELECT * FROM users", True),
+    ("SELECT * FROM users;", True),
+    ("SELECT * INTO backup FROM users", False),
+    ("SELECT 1; DELETE FROM users", False),
+    ("INSERT INTO users VALUES (1)", False),
+    ("EXEC sp_who", False),
+])
+def test_is_read_only_query(query, expected):
+    """Test which statements are considered safe to run twice."""
+    assert is_read_only_query(query) is expected
+
+@pytest.mark.parametrize("query, expected", [
+    ("SELECT 1", True),
+    ("  select * from users", True),
+    ("-- leading comment\nSELECT 1", True),
+    ("/* multi\n line */ SELECT 1", True),
+    ("/* a */ -- b\n/* c */select name from users", True),
+    ("SELECT*FROM users", True),
+    ("select", True),
+    ("SELECTED_ROWS", False),
+    ("UPDATE users SET name = 'x'", False),
+    ("-- SELECT\nDELETE FROM users", False),
+    ("/* SELECT */ DELETE FROM users", False),
+    ("-- only a comment", False),
+    ("", False),
+])
+def test_is_select_query(query, expected):
+    """Test SELECT detection with leading comments and whitespace."""
+    assert is_select_query(query) is expected
+
+def test_format_rows_fetches_in_batches():
+    """Test that result sets are rendered as CSV across several fetchmany calls."""
+    cursor = Mock()
+    cursor.description = [("id",), ("name",)]
+    cursor.fetchmany.side_effect = [[(1, "a"), (2, "b")], [(3, "c")], []]
+    assert format_rows(cursor) == "id,name\n1,a\n2,b\n3,c"
+    assert cursor.fetchmany.call_count == 3
+
+def test_format_rows_stops_at_max_rows():
+    """Test that rows past the cap are not fetched and truncation is reported."""
+    cursor = Mock()
+    cursor.description = [("id",)]
+    cursor.fetchmany.side_effect = [[(1,), (2,), (3,)]]
+    text = format_rows(cursor, max_rows=2)
+    assert text.splitlines() == ["id", "1", "2", "(truncated at 2 rows; raise MSSQL_MAX_ROWS to see more)"]
+    cursor.fetchmany.assert_called_once_with(3)
+
+def test_format_rows_at_exactly_max_rows_is_not_truncated():
+    """Test that a result of exactly max_rows rows carries no truncation note."""
+    cursor = Mock()
+    cursor.description = [("id",)]
+    cursor.fetchmany.side_effect = [[(1,), (2,)], []]
+    assert format_rows(cursor, max_rows=2) == "id\n1\n2"
+
+def test_format_rows_quotes_special_values():
+    """Test that commas, quotes and newlines in values produce valid CSV."""
+    cursor = Mock()
+    cursor.description = [("id",), ("note",)]
+    cursor.fetchmany.side_effect = [[(1, 'a,b'), (2, 'say "hi"'), (3, "x\ny")], []]
+    assert format_rows(cursor) == 'id,note\n1,"a,b"\n2,"say ""hi"""\n3,"x\ny"'
+
+def test_detect_driver_prefers_newest():
+    """Test that the newest installed SQL Server driver is chosen."""
+    installed = ["SQL Server", "ODBC Driver 17 for SQL Server", "ODBC Driver 18 for SQL Server"]
+    with patch("pyodbc.drivers", return_value=installed):
+        assert detect_driver() == "ODBC Driver 18 for SQL Server"
+    with patch("pyodbc.drivers", return_value=["PostgreSQL Unicode"]):
+        assert detect_driver() == "ODBC Driver 17 for SQL Server"
+
+def test_fetch_tables_joins_row_counts():
+    """Test that table names and row counts come from one batched execute."""
+    conn = Mock()
+    cursor = conn.cursor.return_value
+    cursor.fetchall.side_effect = [
+        [("dbo", "users"), ("sales", "orders")],
+        [("dbo", "users", 42)],
+    ]
+    cursor.nextset.return_value = True
+    tables = fetch_tables.__wrapped__(conn)
+    assert tables == [("dbo", "users", 42), ("sales", "orders", None)]
+    cursor.execute.assert_called_once()
+
+@pytest.fixture
+def string_agg_enabled():
+    """Reset the process-wide STRING_AGG support flag around a test."""
+    import mssql_mcp_server.server as server
+    server._string_agg_supported = True
+    yield server
+    server._string_agg_supported = True
+
+def test_table_listing_is_aggregated_on_server(string_agg_enabled):
+    """Test that a plain table listing is answered with one STRING_AGG row."""
+    conn = Mock()
+    cursor = conn.cursor.return_value
+    cursor.fetchone.return_value = ("users\norders", 2)
+    text = execute_query.__wrapped__(conn, "SELECT TABLE_NAME FROM INFORMATION_SCHEMA.TABLES")
+    assert text == "Tables_found\nusers\norders"
+    assert "STRING_AGG" in cursor.execute.call_args[0][0]
+
+def test_table_listing_aggregate_is_capped(string_agg_enabled):
+    """Test that the STRING_AGG listing reports truncation like the row path."""
+    cursor = Mock()
+    cursor.fetchone.return_value = ("users", 5)
+    text = string_agg_enabled.aggregate_table_names(cursor, "", 1)
+    assert text.splitlines() == ["Tables_found", "users", "(truncated at 1 rows; raise MSSQL_MAX_ROWS to see more)"]
+    assert cursor.execute.call_args[0][1] == 1
+
+@pytest.mark.parametrize("message, disabled", [
+    ("'STRING_AGG' is not a recognized built-in function name. (195) (SQLExecDirectW)", True),
+    ("The SELECT permission was denied on the object 'TABLES'. (229) (SQLExecDirectW)", False),
+])
+def test_string_agg_only_disabled_when_unsupported(string_agg_enabled, message, disabled):
+    """Test that only the unknown-function error turns STRING_AGG off."""
+    import pyodbc
+    cursor = Mock()
+    cursor.execute.side_effect = pyodbc.ProgrammingError("42000", message)
+    assert string_agg_enabled.aggregate_table_names(cursor, "", 0) is None
+    assert string_agg_enabled._string_agg_supported is not disabled
+
+def test_read_table_header_follows_current_columns():
+    """Test that a renamed column shows up in the next read's header."""
+    conn = Mock()
+    cursor = conn.cursor.return_value
+    cursor.fetchmany.side_effect = [[(1, "a")], [], [(1, "a")], []]
+    with patch("mssql_mcp_server.server.get_pool", return_value=ConnectionPool(size=1)):
+        cursor.description = [("id",), ("name",)]
+        assert read_table.__wrapped__(conn, "[users]") == "id,name\n1,a"
+        cursor.description = [("id",), ("full_name",)]
+        assert read_table.__wrapped__(conn, "[users]") == "id,full_name\n1,a"
+
+@pytest.mark.parametrize("query, expected", [
+    ("CREATE TABLE t (id int)", True),
+    ("-- comment\nDROP TABLE t", True),
+    ("SET NOCOUNT ON; ALTER TABLE t ADD c int", True),
+    ("EXEC sp_rename 'old', 'new'", True),
+    ("SELECT * FROM t", False),
+    ("CREATE INDEX ix ON t (id)", False),
+])
+def test_table_ddl_detection(query, expected):
+    """Test which statements invalidate the cached table listing."""
+    assert bool(_TABLE_DDL_RE.search(query)) is expected
+
+def test_settings_are_read_once(monkeypatch):
+    """Test that tuning settings are cached until the cache is cleared."""
+    monkeypatch.setenv("MSSQL_MAX_ROWS", "50")
+    get_settings.cache_clear()
+    try:
+        assert get_settings().max_rows == 50
+        monkeypatch.setenv("MSSQL_MAX_ROWS", "not-a-number")
+        assert get_settings().max_rows == 50
+        get_settings.cache_clear()
+        assert get_settings().max_rows == 1000
+    finally:
+        get_settings.cache_clear()
+
+@pytest.fixture
+def table_cache():
+    """Start from an empty table cache with a mocked fetch_tables."""
+    invalidate_tables_cache()
+    with patch("mssql_mcp_server.server.fetch_tables",
+               return_value=[("dbo", "users", 3)]) as fetch:
+        yield fetch
+    invalidate_tables_cache()
+
+@pytest.mark.asyncio
+async def test_list_resources_uses_cache(table_cache):
+    """Test that a fresh cached listing is returned without querying again."""
+    first = await list_resources()
+    second = await list_resources()
+    assert [r.name for r in second] == [r.name for r in first] == ["Table: users"]
+    assert table_cache.call_count == 1
+
+@pytest.mark.asyncio
+async def test_list_resources_cache_expires(table_cache):
+    """Test that the listing is fetched again once the TTL has passed."""
+    with patch("mssql_mcp_server.server.time.monotonic", return_value=1000.0):
+        await list_resources()
+    with patch("mssql_mcp_server.server.time.monotonic",
+               return_value=1000.0 + get_settings().schema_ttl):
+        await list_resources()
+    assert table_cache.call_count == 2
+
+@pytest.mark.asyncio
+async def test_list_resources_cache_invalidated_by_ddl(table_cache):
+    """Test that CREATE TABLE through the tool forces a fresh listing."""
+    await list_resources()
+    with patch("mssql_mcp_server.server.execute_query", return_value="ok"):
+        await call_tool("execute_sql", {"query": "CREATE TABLE t (id int)"})
+    await list_resources()
+    assert table_cache.call_count == 2
+
+@pytest.mark.asyncio
+async def test_list_resources_cache_invalidated_by_failed_ddl(table_cache):
+    """Test that DDL in a batch that then fails still forces a fresh listing."""
+    await list_resources()
+    with patch("mssql_mcp_server.server.execute_query", side_effect=RuntimeError("boom")):
+        result = await call_tool("execute_sql", {"query": "CREATE TABLE t (id int); SELECT 1/0"})
+    assert result[0].text == "Error executing query: boom"
+    await list_resources()
+    assert table_cache.call_count == 2
+
+@pytest.mark.asyncio
+async def test_list_resources_failure_not_cached(table_cache):
+    """Test that a failed fetch is retried on the next call."""
+    table_cache.side_effect = [RuntimeError("boom"), [("dbo", "users", 3)]]
+    assert await list_resources() == []
+    assert len(await list_resources()) == 1
+    assert table_cache.call_count == 2
+
+def test_execute_query_caps_rows_on_client(monkeypatch):
+    """Test that MSSQL_MAX_ROWS caps output without SET ROWCOUNT."""
+    monkeypatch.setenv("MSSQL_MAX_ROWS", "2")
+    get_settings.cache_clear()
+    try:
+        conn = Mock()
+        cursor = conn.cursor.return_value
+        cursor.description = [("id",)]
+        cursor.fetchmany.side_effect = [[(1,), (2,), (3,)]]
+        text = execute_query.__wrapped__(conn, "SELECT id FROM users")
+        assert text.endswith("(truncated at 2 rows; raise MSSQL_MAX_ROWS to see more)")
+        executed = [c.args[0] for c in cursor.execute.call_args_list]
+        assert executed == ["SELECT id FROM users"]
+    finally:
+        get_settings.cache_clear()
+
+@pytest.mark.parametrize("value, expected", [("0", 0), ("-1", 1000), ("abc", 1000)])
+def test_invalid_settings_use_default(monkeypatch, value, expected):
+    """Test that negative or non-numeric settings fall back to the default."""
+    monkeypatch.setenv("MSSQL_MAX_ROWS", value)
+    get_settings.cache_clear()
+    try:
+        assert get_settings().max_rows == expected
+    finally:
+        get_settings.cache_clear()
+
+def test_read_table_uses_resource_rows(monkeypatch):
+    """Test that MSSQL_RESOURCE_ROWS is bound as the TOP parameter."""
+    monkeypatch.setenv("MSSQL_RESOURCE_ROWS", "25")
+    get_settings.cache_clear()
+    try:
+        conn = Mock()
+        cursor = conn.cursor.return_value
+        cursor.description = [("id",)]
+        cursor.fetchmany.side_effect = [[]]
+        with patch("mssql_mcp_server.server.get_pool", return_value=ConnectionPool(size=1)):
+            read_table.__wrapped__(conn, "[users]")
+        cursor.execute.assert_called_once_with("SELECT TOP (?) * FROM [users]", 25)
+    finally:
+        get_settings.cache_clear()
+
 @pytest.mark.asyncio
 async def test_list_tools():
     """Test that list_tools returns expected tools."""